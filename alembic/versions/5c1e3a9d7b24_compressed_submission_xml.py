@@ -0,0 +1,48 @@
+"""compressed submission_xml
+
+Revision ID: 5c1e3a9d7b24
+Revises: 01fb17d68678
+Create Date: 2026-10-15 10:12:31.402117
+
+"""
+import gzip
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e3a9d7b24'
+down_revision = '01fb17d68678'
+branch_labels = None
+depends_on = None
+
+GZIP_MAGIC_NUMBER = b'\x1f\x8b'
+
+
+def upgrade():
+    # os registros existentes são mantidos em texto puro e lidos como tal pelo
+    # tipo CompressedText; somente os novos são gravados comprimidos.
+    op.alter_column('deposit', 'submission_xml',
+                    type_=sa.LargeBinary(), existing_type=sa.Text(),
+                    postgresql_using="convert_to(submission_xml, 'UTF8')")
+
+
+def downgrade():
+    connection = op.get_bind()
+    deposit = sa.table('deposit', sa.column('code', sa.String),
+                       sa.column('submission_xml', sa.LargeBinary))
+
+    # somente os registros comprimidos são lidos, um a um, por meio de um
+    # cursor no servidor.
+    rows = connection.execution_options(stream_results=True).execute(
+        sa.select([deposit.c.code, deposit.c.submission_xml]).where(
+            sa.func.substring(deposit.c.submission_xml, 1, 2) == GZIP_MAGIC_NUMBER))
+    for code, submission_xml in rows:
+        connection.execute(
+            deposit.update().where(deposit.c.code == code).values(
+                submission_xml=gzip.decompress(bytes(submission_xml))))
+
+    op.alter_column('deposit', 'submission_xml',
+                    type_=sa.Text(), existing_type=sa.LargeBinary(),
+                    postgresql_using="convert_from(submission_xml, 'UTF8')")
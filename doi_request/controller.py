@@ -1,6 +1,6 @@
 import logging
 
-from tasks.celery import registry_dispatcher_document
+from tasks.celery import app, registry_dispatcher_document
 
 
 logger = logging.getLogger(__name__)
@@ -13,8 +13,10 @@ class Depositor(object):
         Receive a list of pids and collection to registry their dois.
         scl
         """
-        for item in pids_list:
-            collection, code = item.split('_')
-            registry_dispatcher_document.delay(code, collection)
-            logger.info('enqueued deposit for "%s"', item)
+        with app.producer_or_acquire() as producer:
+            for item in pids_list:
+                collection, code = item.split('_')
+                registry_dispatcher_document.apply_async(
+                    (code, collection), producer=producer)
+                logger.info('enqueued deposit for "%s"', item)
 
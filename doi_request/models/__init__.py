@@ -1,4 +1,5 @@
 import os
+import functools
 from contextlib import contextmanager
 
 from sqlalchemy.ext.declarative import declarative_base
@@ -23,11 +24,19 @@ def initialize_sql(engine):
     Base.metadata.create_all(engine)
 
 
-PlainSession = sessionmaker(bind=create_engine_from_env())
+PlainSession = sessionmaker()
+
+
+@functools.lru_cache(maxsize=1)
+def _plain_session_engine():
+    """A engine é criada no primeiro uso, e não na importação do módulo.
+    """
+    return create_engine_from_env()
+
 
 @contextmanager
 def transactional_session():
-    session = PlainSession()
+    session = PlainSession(bind=_plain_session_engine())
     try:
         yield session
         session.commit()
@@ -1,7 +1,36 @@
+import gzip
 from datetime import datetime
 from doi_request.models import Base
-from sqlalchemy import func, ForeignKey, Column, Unicode, Integer, String, Boolean, Text, DateTime, Float
+from sqlalchemy import func, ForeignKey, Column, Unicode, Integer, String, Boolean, Text, DateTime, Float, LargeBinary
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator
+
+GZIP_MAGIC_NUMBER = b'\x1f\x8b'
+
+
+class CompressedText(TypeDecorator):
+    """Texto armazenado no banco de dados comprimido com gzip.
+
+    Os valores são lidos e escritos como `str`. Valores gravados antes da
+    compressão, em texto puro, continuam sendo lidos normalmente.
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not value:
+            return b''
+        return gzip.compress(value.encode('utf-8'), compresslevel=6)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        value = bytes(value)
+        if value.startswith(GZIP_MAGIC_NUMBER):
+            value = gzip.decompress(value)
+        return value.decode('utf-8')
 
 
 class Deposit(Base):
@@ -23,7 +52,7 @@ class Deposit(Base):
     is_xml_valid = Column('is_xml_valid', Boolean, default=False)
     started_at = Column('started_at', DateTime(timezone=True), nullable=False, index=True)
     updated_at = Column('updated_at', DateTime(timezone=True), nullable=False)
-    submission_xml = Column('submission_xml', Text, default='')
+    submission_xml = Column('submission_xml', CompressedText, default='')
     submission_status = Column('submission_status', String(16), default='unknow', index=True)
     submission_updated_at = Column('submission_updated_at', DateTime(timezone=True))
     submission_response = Column('submission_response', Text, default='')
@@ -27,7 +27,8 @@ import logging.config
 from lxml import etree
 
 from doi_request.models.depositor import Deposit, LogEvent, Expenses
-from doi_request.models import configure_session_engine, DBSession
+from doi_request.models import (
+    configure_session_engine, create_engine_from_env, DBSession)
 
 logger = logging.getLogger(__name__)
 
@@ -76,9 +77,6 @@ if SENTRY_HANDLER:
     }
     LOGGING['loggers']['']['handlers'].append('sentry')
 
-# Database Config
-configure_session_engine()
-
 
 class Export2Id(object):
 
@@ -173,6 +171,9 @@ def main():
         content['level'] = args.logging_level
     logging.config.dictConfig(LOGGING)
 
+    # Database Config
+    configure_session_engine(create_engine_from_env())
+
     export = Export2Id(args.output_file)
 
     export.run()
@@ -5,11 +5,11 @@ Este processamento realiza a exportação de registros SciELO para o Crossref
 import os
 import argparse
 import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
-from articlemeta.client import ThriftClient
-
-from doi_request.controller import Depositor
 from processing import utils
 
 logger = logging.getLogger('exportDOI')
@@ -20,35 +20,107 @@ FROM = datetime.now() - timedelta(days=30)
 FROM = FROM.isoformat()[:10]
 UNTIL = datetime.now().isoformat()[:10]
 
+QUEUE_MAXSIZE = 256
+DISPATCH_BATCH_SIZE = 256
+MAX_PRODUCERS = 8
+QUEUE_PUT_TIMEOUT = 1
+
+_END_OF_STREAM = None
+
 
 class ExportDOI(object):
 
     def __init__(self, collection, issns=None, from_date=FROM,
-            until_date=UNTIL):
-
-        self._articlemeta = ThriftClient(domain=os.environ.get(
-            'ARTICLEMETA_THRIFTSERVER', 'articlemeta.scielo.org:11621'))
-        self._depositor = Depositor()
+            until_date=UNTIL, articlemeta=None, depositor=None):
+        # importados aqui para que `--help` e a validação dos argumentos não
+        # carreguem lxml, Celery, SQLAlchemy e o cliente Thrift.
+        if articlemeta is None:
+            from articlemeta.client import ThriftClient
+            articlemeta = ThriftClient(domain=os.environ.get(
+                'ARTICLEMETA_THRIFTSERVER', 'articlemeta.scielo.org:11621'))
+        if depositor is None:
+            from doi_request.controller import Depositor
+            depositor = Depositor()
+
+        self._articlemeta = articlemeta
+        self._depositor = depositor
         self.collection = collection
         self.from_date = from_date
         self.until_date = until_date
         self.issns = issns or [None]
 
-    def run(self):
-        logger.info('started collecting articles with processing dates '
-                    'between "%s" and "%s"', self.from_date, self.until_date)
-        count = 0
-        for issn in self.issns:
+    def _put(self, documents_queue, item, stop):
+        """Enfileira `item`, desistindo caso o consumidor tenha sido
+        interrompido. Retorna `False` quando o item não foi enfileirado.
+        """
+        while not stop.is_set():
+            try:
+                documents_queue.put(item, timeout=QUEUE_PUT_TIMEOUT)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def _produce(self, issn, documents_queue, stop):
+        """Percorre os documentos do ArticleMeta de um ISSN e os enfileira para
+        o consumidor. O fim do fluxo é sinalizado com `_END_OF_STREAM`.
+        """
+        try:
+            if stop.is_set():
+                return
 
             for document in self._articlemeta.documents(
                     collection=self.collection, issn=issn,
                     from_date=self.from_date, until_date=self.until_date,
                     only_identifiers=True):
+                if stop.is_set():
+                    return
+                if not self._put(documents_queue, document, stop):
+                    return
+        finally:
+            self._put(documents_queue, _END_OF_STREAM, stop)
+
+    def run(self):
+        logger.info('started collecting articles with processing dates '
+                    'between "%s" and "%s"', self.from_date, self.until_date)
+        documents_queue = queue.Queue(maxsize=QUEUE_MAXSIZE)
+        stop = threading.Event()
 
-                code = '_'.join([document.collection, document.code])
-                logger.info('collecting document for deposit: %s', code)
-                self._depositor.deposit_by_pids([code])
-                count += 1
+        count = 0
+        codes = []
+        with ThreadPoolExecutor(
+                max_workers=min(MAX_PRODUCERS, len(self.issns))) as executor:
+            producers = [
+                executor.submit(self._produce, issn, documents_queue, stop)
+                for issn in self.issns
+            ]
+
+            try:
+                finished = 0
+                while finished < len(producers):
+                    document = documents_queue.get()
+                    if document is _END_OF_STREAM:
+                        finished += 1
+                        continue
+
+                    code = '_'.join([document.collection, document.code])
+                    logger.info('collecting document for deposit: %s', code)
+                    codes.append(code)
+                    count += 1
+
+                    if len(codes) >= DISPATCH_BATCH_SIZE:
+                        self._depositor.deposit_by_pids(codes)
+                        codes = []
+
+                if codes:
+                    self._depositor.deposit_by_pids(codes)
+            finally:
+                stop.set()
+                for producer in producers:
+                    producer.cancel()
+
+        for producer in producers:
+            producer.result()
 
         logger.info('finished collecting documents. total: %d', count)
 
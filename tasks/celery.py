@@ -8,6 +8,7 @@ from celery import Celery
 from celery import Task, chain
 from celery.utils.log import get_task_logger
 from lxml import etree
+from sqlalchemy.orm import defer
 from articlemeta.client import ThriftClient, ServerError
 
 from crossref.client import CrossrefClient
@@ -50,8 +51,9 @@ REGISTER_DOI_DELAY_RETRY = int(os.environ.get('REGISTER_DOI_DELAY_RETRY', '600')
 REQUEST_DOI_DELAY_RETRY_TD = timedelta(seconds=REQUEST_DOI_DELAY_RETRY)
 REGISTER_DOI_DELAY_RETRY_TD = timedelta(seconds=REGISTER_DOI_DELAY_RETRY)
 SUGGEST_DOI_IDENTIFICATION = asbool(os.environ.get('SUGGEST_DOI_IDENTIFICATION', False))
-CROSSREF_XSD = open(os.path.dirname(__file__)+'/../xsd/crossref4.4.0.xsd')
+CROSSREF_XSD = os.path.join(os.path.dirname(__file__), '..', 'xsd', 'crossref4.4.0.xsd')
 CROSSREF_PREFIX = os.environ.get('CROSSREF_PREFIX', None)
+CROSSREF_PREFIX_LOWER = CROSSREF_PREFIX.lower() if CROSSREF_PREFIX else None
 CROSSREF_API_USER = os.environ.get('CROSSREF_API_USER', None)
 CROSSREF_API_PASSWORD = os.environ.get('CROSSREF_API_PASSWORD', None)
 CROSSREF_DEPOSITOR_NAME = os.environ.get('CROSSREF_DEPOSITOR_NAME', None)
@@ -59,24 +61,104 @@ CROSSREF_DEPOSITOR_EMAIL = os.environ.get('CROSSREF_DEPOSITOR_EMAIL', None)
 ARTICLEMETA_THRIFTSERVER = os.environ.get(
     'ARTICLEMETA_THRIFTSERVER', 'articlemeta.scielo.org:11621')
 
+CROSSREF_NAMESPACES = {'c': 'http://www.crossref.org/schema/4.4.0'}
+CR_NS = '{http://www.crossref.org/schema/4.4.0}'
+
+# Os elementos do depositante são filhos diretos de `doi_batch/head`, então
+# são obtidos a partir dele em vez de percorrer todo o documento.
+_HEAD_PATH = CR_NS + 'head'
+_REGISTRANT_PATH = CR_NS + 'registrant'
+_DEPOSITOR_NAME_PATH = CR_NS + 'depositor/' + CR_NS + 'depositor_name'
+_EMAIL_ADDRESS_PATH = CR_NS + 'depositor/' + CR_NS + 'email_address'
+_DOI_BATCH_ID_PATH = CR_NS + 'doi_batch_id'
+_CITATION_LIST_PATH = './/' + CR_NS + 'citation_list'
+
+# Consultas XPath compiladas uma única vez e reutilizadas a cada documento.
+_XP_DOI = etree.XPath('//c:doi_data/c:doi', namespaces=CROSSREF_NAMESPACES)
+
+XML_PARSER = etree.XMLParser(
+    huge_tree=False, collect_ids=False, remove_blank_text=False)
+
 crossref_client = CrossrefClient(
     CROSSREF_PREFIX, CROSSREF_API_USER, CROSSREF_API_PASSWORD)
 
 
-def _parse_schema():
+@functools.lru_cache(maxsize=1)
+def _load_schema():
+    """Obtém o schema do Crossref, que é compilado uma única vez por processo.
+
+    Falhas são propagadas e não ficam em cache, de modo que a próxima chamada
+    tenta carregar o schema novamente.
+    """
+    try:
+        with open(CROSSREF_XSD, 'rb') as f:
+            return etree.XMLSchema(etree.parse(f))
+    except Exception as e:
+        logger.exception(e)
+        logger.error('Fail to parse Crossref XSD')
+        raise
+
+
+def setup_depositor(xml, doi, depositor_name, depositor_email):
+    head = xml.getroot().find(_HEAD_PATH)
+    registrant_element = head.find(_REGISTRANT_PATH)
+    registrant_element.text = depositor_name
+    depositor_name_element = head.find(_DEPOSITOR_NAME_PATH)
+    depositor_name_element.text = depositor_name
+    depositor_email_element = head.find(_EMAIL_ADDRESS_PATH)
+    depositor_email_element.text = depositor_email
+    doi_element = _XP_DOI(xml)[0]
+    doi_element.text = doi
+
+    return xml
+
+
+def xml_is_valid(xml, doi, depositor_name, depositor_email,
+        only_front=False):
+    """Aplica os dados do depositante e o `doi` ao XML e o valida contra o
+    schema do Crossref.
 
+    Não lê configurações do módulo e retorna somente valores serializáveis
+    (`is_valid`, `xml_bytes`, `doi_batch_id`, `exc`), podendo ser executada em
+    outro processo.
+    """
+    xml_bytes = xml.encode('utf-8') if isinstance(xml, str) else xml
     try:
-        sch_doc = etree.parse(CROSSREF_XSD)
-        sch = etree.XMLSchema(sch_doc)
+        xml_doc = etree.fromstring(
+            xml_bytes, parser=XML_PARSER).getroottree()
+        logger.debug('XML is well formed')
     except Exception as e:
         logger.exception(e)
         logger.error('Fail to parse XML')
-        return False
+        return (False, xml_bytes, '', str(e))
 
-    return sch
+    xml_doc = setup_depositor(
+        xml_doc, doi, depositor_name, depositor_email)
 
+    if only_front:
+        citation_list = xml_doc.getroot().find(_CITATION_LIST_PATH)
+        if citation_list is not None:
+            citation_list.getparent().remove(citation_list)
 
-PARSED_SCHEMA = _parse_schema()
+    # o mesmo conteúdo serializado é validado e persistido, evitando
+    # uma nova serialização da árvore.
+    xml_doc_serialized = etree.tostring(xml_doc, encoding='utf-8',
+            xml_declaration=True)
+
+    # o documento é lido novamente a partir do conteúdo serializado para que
+    # as linhas indicadas nos erros de validação correspondam ao XML
+    # persistido.
+    valid_xml_doc = etree.fromstring(xml_doc_serialized, parser=XML_PARSER)
+    try:
+        _load_schema().assertValid(valid_xml_doc)
+        logger.debug('XML is valid')
+    except etree.DocumentInvalid as e:
+        logger.exception(e)
+        logger.error('Fail to parse XML')
+        return (False, xml_doc_serialized, '', str(e))
+
+    doi_batch_id = valid_xml_doc.find(_HEAD_PATH).find(_DOI_BATCH_ID_PATH).text
+    return (True, xml_doc_serialized, doi_batch_id, '')
 
 
 def log_call(f):
@@ -94,18 +176,51 @@ def log_event(session, data):
     session.add(log)
 
 
+def query_deposit_without_documents(session, code):
+    """Obtém o depósito sem carregar os XMLs de submissão e de retorno nem a
+    resposta do Crossref, para as etapas que não os leem.
+    """
+    return session.query(Deposit).options(
+            defer(Deposit.submission_xml),
+            defer(Deposit.feedback_xml),
+            defer(Deposit.submission_response),
+        ).filter_by(code=code).first()
+
+
+def is_prefix_applicable(prefix):
+    if CROSSREF_PREFIX_LOWER is None:
+        raise ValueError('CROSSREF_PREFIX is not set')
+    return prefix.lower() == CROSSREF_PREFIX_LOWER
+
+
+def mark_as_not_applicable(session, deposit, now):
+    """Marca o depósito como não aplicável, pois o prefixo do seu DOI não
+    pertence à coleção. Retorna o título do evento registrado.
+    """
+    deposit.submission_status = 'notapplicable'
+    deposit.feedback_status = 'notapplicable'
+    deposit.submission_updated_at = now
+    deposit.feedback_updated_at = now
+    deposit.updated_at = now
+
+    log_title = 'DOI prefix for this document (%s) does not match with the collection\'s (%s)' % (deposit.prefix, CROSSREF_PREFIX)
+    log_event(session, {'title': log_title, 'type': 'general', 'status': 'notapplicable', 'deposit_code': deposit.code})
+
+    return log_title
+
+
 @app.task(bind=True, throws=(ChainAborted,))
 @log_call
 def triage_deposit(self, code):
+    now = datetime.now()
     log_title = ''
 
     with transactional_session() as session:
-        deposit = session.query(Deposit).filter_by(code=code).first()
+        deposit = query_deposit_without_documents(session, code)
 
         if not deposit.doi:
             logger.info('cannot get DOI from deposit "%s" of code "%s"',
                     deposit.id, code)
-            now = datetime.now()
             deposit.submission_status = 'error'
             deposit.submission_updated_at = now
             deposit.updated_at = now
@@ -113,16 +228,8 @@ def triage_deposit(self, code):
             log_title = 'DOI number not defined for this document'
             log_event(session, {'title': log_title, 'type': 'submission', 'status': 'error', 'deposit_code': code})
 
-        elif deposit.prefix.lower() != CROSSREF_PREFIX.lower():
-            now = datetime.now()
-            deposit.submission_status = 'notapplicable'
-            deposit.feedback_status = 'notapplicable'
-            deposit.submission_updated_at = now
-            deposit.feedback_updated_at = now
-            deposit.updated_at = now
-
-            log_title = 'DOI prefix for this document (%s) does not match with the collection\'s (%s)' % (deposit.prefix, CROSSREF_PREFIX)
-            log_event(session, {'title': log_title, 'type': 'general', 'status': 'notapplicable', 'deposit_code': code})
+        elif not is_prefix_applicable(deposit.prefix):
+            log_title = mark_as_not_applicable(session, deposit, now)
 
     if log_title:
         raise ChainAborted(log_title + ': ' + code)
@@ -134,12 +241,13 @@ def triage_deposit(self, code):
         autoretry_for=(ServerError,), retry_backoff=True)
 @log_call
 def load_xml_from_articlemeta(self, code):
+    now = datetime.now()
     articlemeta = ThriftClient(domain=ARTICLEMETA_THRIFTSERVER)
 
     exc_log_title = ''
 
     with transactional_session() as session:
-        deposit = session.query(Deposit).filter_by(code=code).first()
+        deposit = query_deposit_without_documents(session, code)
 
         log_title = 'Loading XML document from ArticleMeta (%s)' % code
         log_event(session, {'title': log_title, 'type': 'submission', 'status': 'info', 'deposit_code': code})
@@ -153,8 +261,8 @@ def load_xml_from_articlemeta(self, code):
             logger.exception(exc)
 
             deposit.submission_status = 'error'
-            deposit.submission_updated_at = datetime.now()
-            deposit.updated_at = datetime.now()
+            deposit.submission_updated_at = now
+            deposit.updated_at = now
 
             log_title = 'Fail to load XML document from ArticleMeta (%s)' % code
             log_event(session, {'title': log_title, 'body': str(exc), 'type': 'submission', 'status': 'error', 'deposit_code': code})
@@ -164,8 +272,8 @@ def load_xml_from_articlemeta(self, code):
         else:
             deposit.submission_status = 'waiting'
             deposit.submission_xml = xml
-            deposit.submission_updated_at = datetime.now()
-            deposit.updated_at = datetime.now()
+            deposit.submission_updated_at = now
+            deposit.updated_at = now
 
             log_title = 'XML Document loaded from ArticleMeta (%s)' % code
             log_event(session, {'title': log_title, 'type': 'submission', 'status': 'success', 'deposit_code': code})
@@ -184,70 +292,29 @@ def prepare_document(self, code):
     Os únicos tipos de erros passíveis de novas tentativas são os de comunicação
     com o banco de dados.
     """
+    now = datetime.now()
     with transactional_session() as session:
         deposit = session.query(Deposit).filter_by(code=code).first()
 
-        def setup_depositor(xml):
-            registrant = xml.find('//{http://www.crossref.org/schema/4.4.0}registrant')
-            registrant.text = CROSSREF_DEPOSITOR_NAME
-            depositor_name = xml.find('//{http://www.crossref.org/schema/4.4.0}depositor_name')
-            depositor_name.text = CROSSREF_DEPOSITOR_NAME
-            depositor_email = xml.find('//{http://www.crossref.org/schema/4.4.0}email_address')
-            depositor_email.text = CROSSREF_DEPOSITOR_EMAIL
-            doi = xml.find('//{http://www.crossref.org/schema/4.4.0}doi_data/{http://www.crossref.org/schema/4.4.0}doi')
-            doi.text = deposit.doi
-
-            return xml
-
-        def xml_is_valid(xml, only_front=False):
-            xml = BytesIO(xml.encode('utf-8'))
-            try:
-                xml_doc = etree.parse(xml)
-                logger.debug('XML is well formed')
-            except Exception as e:
-                logger.exception(e)
-                logger.error('Fail to parse XML')
-                return (False, '', str(e))
-
-            xml_doc = setup_depositor(xml_doc)
-
-            if only_front:
-                citation_list = xml_doc.find(
-                    '//{http://www.crossref.org/schema/4.4.0}citation_list')
-                if citation_list:
-                    citation_list.getparent().remove(citation_list)
-
-            xml_doc_pprint = etree.tostring(xml_doc, pretty_print=True)
-            xml_doc = etree.parse(BytesIO(xml_doc_pprint))
-
-            try:
-                result = PARSED_SCHEMA.assertValid(xml_doc)
-                logger.debug('XML is valid')
-                return (True, xml_doc, '')
-            except etree.DocumentInvalid as e:
-                logger.exception(e)
-                logger.error('Fail to parse XML')
-                return (False, xml_doc, str(e))
-
-        is_valid, parsed_xml, exc = xml_is_valid(deposit.submission_xml)
-        deposit.submission_xml = etree.tostring(parsed_xml, encoding='utf-8', pretty_print=True, xml_declaration=True).decode('utf-8')
+        is_valid, xml_bytes, doi_batch_id, exc = xml_is_valid(
+            deposit.submission_xml, deposit.doi,
+            CROSSREF_DEPOSITOR_NAME, CROSSREF_DEPOSITOR_EMAIL
+        )
+        deposit.submission_xml = xml_bytes.decode('utf-8')
 
         if is_valid is True:
             log_title = 'XML is valid, it will be submitted to Crossref'
-            now = datetime.now()
             logger.info(log_title)
             deposit.is_xml_valid = True
             deposit.has_submission_xml_valid_references = True
             deposit.submission_status = 'waiting'
             deposit.submission_updated_at = now
-            deposit.doi_batch_id = parsed_xml.find(
-                '//{http://www.crossref.org/schema/4.4.0}doi_batch_id').text
+            deposit.doi_batch_id = doi_batch_id
 
             log_event(session, {'title': log_title, 'type': 'submission', 'status': 'success', 'deposit_code': code})
             return code
 
         log_title = 'XML with references is invalid, fail to parse xml for document (%s)' % code
-        now = datetime.now()
         logger.warning(log_title)
         deposit.is_xml_valid = False
         deposit.submission_status = 'error'
@@ -257,32 +324,29 @@ def prepare_document(self, code):
         log_event(session, {'title': log_title, 'body': str(exc), 'type': 'submission', 'status': 'error', 'deposit_code': code})
 
         log_title = 'Trying to send XML without references'
-        now = datetime.now()
         logger.debug(log_title)
 
         log_event(session, {'title': log_title, 'type': 'submission', 'status': 'info', 'deposit_code': code})
 
-        is_valid, parsed_xml, exc = xml_is_valid(
-            deposit.submission_xml, only_front=True
+        is_valid, xml_bytes, doi_batch_id, exc = xml_is_valid(
+            deposit.submission_xml, deposit.doi,
+            CROSSREF_DEPOSITOR_NAME, CROSSREF_DEPOSITOR_EMAIL, only_front=True
         )
-        deposit.submission_xml = etree.tostring(parsed_xml, encoding='utf-8', pretty_print=True, xml_declaration=True).decode('utf-8')
+        deposit.submission_xml = xml_bytes.decode('utf-8')
 
         if is_valid is True:
             log_title = 'XML only with front metadata is valid, it will be submitted to Crossref'
-            now = datetime.now()
             logger.info(log_title)
             deposit.is_xml_valid = True
             deposit.submission_status = 'waiting'
             deposit.submission_updated_at = now
-            deposit.doi_batch_id = parsed_xml.find(
-                '//{http://www.crossref.org/schema/4.4.0}doi_batch_id').text
+            deposit.doi_batch_id = doi_batch_id
 
             log_event(session, {'title': log_title, 'type': 'submission', 'status': 'success', 'deposit_code': code})
 
             return code
 
         log_title = 'XML only with front metadata is also invalid, fail to parse xml for document (%s)' % code
-        now = datetime.now()
         logger.error(log_title)
         deposit.is_xml_valid = False
         deposit.submission_status = 'error'
@@ -298,6 +362,7 @@ def prepare_document(self, code):
         max_retries=REGISTER_DOI_MAX_RETRY, throws=(ChainAborted,))
 @log_call
 def register_doi(self, code):
+    now = datetime.now()
     should_abort_chain, exc_class, exc_log_title = (False, None, '')
 
     with transactional_session() as session:
@@ -310,11 +375,10 @@ def register_doi(self, code):
             result = crossref_client.register_doi(code, deposit.submission_xml)
         except Exception as exc:
             log_title = 'Fail to Connect to Crossref API, retrying at (%s) to submit (%s)' % (
-                datetime.now()+REGISTER_DOI_DELAY_RETRY_TD, code
+                now+REGISTER_DOI_DELAY_RETRY_TD, code
             )
             logger.error(log_title)
 
-            now = datetime.now()
             deposit.submission_status = 'waiting'
             deposit.submission_updated_at = now
             deposit.updated_at = now
@@ -325,10 +389,9 @@ def register_doi(self, code):
 
             if result.status_code != 200:
                 log_title = 'Fail to Connect to Crossref API, retrying at (%s) to submit (%s)' % (
-                    datetime.now()+REGISTER_DOI_DELAY_RETRY_TD, code
+                    now+REGISTER_DOI_DELAY_RETRY_TD, code
                 )
                 logger.error(log_title)
-                now = datetime.now()
                 deposit.submission_log = log_title
                 deposit.submission_status = 'waiting'
                 deposit.submission_updated_at = now
@@ -340,7 +403,6 @@ def register_doi(self, code):
             elif result.status_code == 200 and 'SUCCESS' in result.text:
                 log_title = 'Success sending metadata for (%s)' % code
                 logger.debug(log_title)
-                now = datetime.now()
                 deposit.submission_status = 'success'
                 deposit.submission_updated_at = now
                 deposit.updated_at = now
@@ -350,7 +412,6 @@ def register_doi(self, code):
 
             else:
                 log_title = 'Fail registering DOI for (%s)' % code
-                now = datetime.now()
                 deposit.submission_status = 'error'
                 deposit.submission_updated_at = now
                 deposit.updated_at = now
@@ -370,7 +431,7 @@ class CallbackTask(Task):
         code = args[0]
 
         with transactional_session() as session:
-            deposit = session.query(Deposit).filter_by(code=code).first()
+            deposit = query_deposit_without_documents(session, code)
 
             log_title = 'Fail to registry DOI (%s) for (%s)' % (
                 deposit.doi, deposit.doi_batch_id
@@ -387,13 +448,13 @@ class CallbackTask(Task):
 @app.task(base=CallbackTask, bind=True, default_retry_delay=REQUEST_DOI_DELAY_RETRY, max_retries=REQUEST_DOI_MAX_RETRY)
 @log_call
 def request_doi_status(self, code):
+    now = datetime.now()
     exc_class, exc_log_title = (None, '')
 
     with transactional_session() as session:
-        deposit = session.query(Deposit).filter_by(code=code).first()
+        deposit = query_deposit_without_documents(session, code)
 
         log_title = 'Checking DOI registering Status for (%s)' % deposit.doi_batch_id
-        now = datetime.now()
         deposit.feedback_status = 'waiting'
         deposit.feedback_updated_at = now
         deposit.updated_at = now
@@ -404,10 +465,9 @@ def request_doi_status(self, code):
             result = crossref_client.request_doi_status_by_batch_id(deposit.doi_batch_id)
         except Exception as exc:
             log_title = 'Fail to Connect to Crossref API, retrying to check submission status at (%s) for (%s)' % (
-                datetime.now()+REQUEST_DOI_DELAY_RETRY_TD, deposit.doi_batch_id
+                now+REQUEST_DOI_DELAY_RETRY_TD, deposit.doi_batch_id
             )
             logger.error(log_title)
-            now = datetime.now()
             deposit.feedback_status = 'waiting'
             deposit.feedback_updated_at = now
             deposit.updated_at = now
@@ -422,7 +482,6 @@ def request_doi_status(self, code):
             doi_batch_status = xml_doc.find('.').get('status')
 
             if result.status_code != 200:
-                now = datetime.now()
                 log_title = 'Fail to Connect to Crossref API, retrying to check submission status at (%s) (%s)' % (
                     now+REQUEST_DOI_DELAY_RETRY_TD, deposit.doi_batch_id
                 )
@@ -436,7 +495,6 @@ def request_doi_status(self, code):
             elif doi_batch_status != 'completed':
                 log_title = 'Crossref has received the request, waiting Crossref to process it (%s)' % deposit.doi_batch_id
                 logger.error(log_title)
-                now = datetime.now()
                 deposit.feedback_status = 'waiting'
                 deposit.feedback_updated_at = now
                 deposit.updated_at = now
@@ -449,7 +507,6 @@ def request_doi_status(self, code):
                 feedback_body = xml_doc.find('.//record_diagnostic/msg').text or ''
                 log_title = 'Crossref final status for (%s) is (%s)' % (deposit.doi_batch_id, feedback_status)
                 logger.info(log_title)
-                now = datetime.now()
                 deposit.feedback_status = feedback_status
                 deposit.feedback_xml = etree.tostring(xml_doc).decode('utf-8')
                 deposit.updated_at = now
@@ -459,10 +516,10 @@ def request_doi_status(self, code):
 
                 if feedback_status == 'success' and 'added' in feedback_body.lower():
                     #crossref backfiles limit current year - 2.
-                    back_file_limit = int(datetime.now().strftime('%Y')) - 2
+                    back_file_limit = int(now.strftime('%Y')) - 2
                     expenses = Expenses()
                     expenses.publication_year = deposit.publication_year
-                    expenses.registry_date = datetime.now()
+                    expenses.registry_date = now
                     expenses.doi = deposit.doi
                     expenses.cost = 0.15 if int(deposit.publication_year) < back_file_limit else 1
                     expenses.retro = True if int(deposit.publication_year) < back_file_limit else False
@@ -487,7 +544,7 @@ def registry_dispatcher_document(self, code, collection):
     logger.info(log_title)
     xml_file_name = '%s.xml' % code
     doi = document.doi or ''
-    doi_prefix = document.doi.split('/')[0] if doi else ''
+    doi_prefix = doi.partition('/')[0]
     now = datetime.now()
 
     if SUGGEST_DOI_IDENTIFICATION is True and not doi:
@@ -516,15 +573,32 @@ def registry_dispatcher_document(self, code, collection):
     )
 
     with transactional_session() as session:
-        deposit = session.query(Deposit).filter_by(code=code).first()
-        if deposit:
+        # os registros anteriores são removidos diretamente no banco, sem
+        # carregar o depósito e cada um de seus eventos para a sessão.
+        session.query(LogEvent).filter_by(deposit_code=code).delete(
+                synchronize_session=False)
+        deleted = session.query(Deposit).filter_by(code=code).delete(
+                synchronize_session=False)
+        if deleted:
             logger.info('deposit already exists. it will be deleted and '
                         're-created: "%s"', code)
-            session.delete(deposit)
 
         session.add(depitem)
-    logger.info('deposit successfuly created for "%s": %s', code,
-            repr(deposit))
+
+        # depósitos de outros prefixos são encerrados aqui mesmo, sem
+        # despachar a cadeia que buscaria o XML no ArticleMeta. Sem
+        # CROSSREF_PREFIX configurado a decisão fica com `triage_deposit`,
+        # que falha explicitamente.
+        not_applicable_title = ''
+        if (doi and CROSSREF_PREFIX_LOWER is not None
+                and not is_prefix_applicable(doi_prefix)):
+            not_applicable_title = mark_as_not_applicable(
+                    session, depitem, now)
+    logger.info('deposit successfuly created for "%s"', code)
+
+    if not_applicable_title:
+        logger.info('%s: %s', not_applicable_title, code)
+        return
 
     chain(
         triage_deposit.s(code).set(queue='dispatcher'),
@@ -0,0 +1,100 @@
+import threading
+import unittest
+
+from processing.exportDOI import ExportDOI, MAX_PRODUCERS
+
+
+class Document(object):
+
+    def __init__(self, issn, number):
+        self.collection = 'scl'
+        self.code = '%s-%d' % (issn, number)
+
+
+class ArticleMetaStub(object):
+
+    def __init__(self, total=300, failing_issn=None, gate=None,
+                 open_issn=None):
+        self.total = total
+        self.failing_issn = failing_issn
+        self.gate = gate
+        self.open_issn = open_issn
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def documents(self, collection=None, issn=None, from_date=None,
+                  until_date=None, only_identifiers=False):
+        with self._lock:
+            self.calls.append(issn)
+        if self.gate is not None and issn != self.open_issn:
+            self.gate.wait()
+        if self.failing_issn is not None and issn == self.failing_issn:
+            raise RuntimeError('articlemeta failure')
+        for number in range(self.total):
+            yield Document(issn, number)
+
+
+class DepositorStub(object):
+
+    def __init__(self, fail=False, on_failure=None):
+        self.fail = fail
+        self.on_failure = on_failure
+        self.codes = []
+
+    def deposit_by_pids(self, codes):
+        if self.fail:
+            if self.on_failure is not None:
+                self.on_failure()
+            raise ValueError('broker failure')
+        self.codes.extend(codes)
+
+
+class ExportDOITest(unittest.TestCase):
+
+    def test_run_dispatches_documents_from_every_issn(self):
+        depositor = DepositorStub()
+        export = ExportDOI('scl', ['0001-0001', '0002-0002', '0003-0003'],
+                           articlemeta=ArticleMetaStub(),
+                           depositor=depositor)
+
+        export.run()
+
+        self.assertEqual(len(depositor.codes), 900)
+        self.assertEqual(len(set(depositor.codes)), 900)
+
+    def test_run_without_issns_uses_a_single_producer(self):
+        depositor = DepositorStub()
+        articlemeta = ArticleMetaStub(total=10)
+        export = ExportDOI('scl', articlemeta=articlemeta,
+                           depositor=depositor)
+
+        export.run()
+
+        self.assertEqual(articlemeta.calls, [None])
+        self.assertEqual(len(depositor.codes), 10)
+
+    def test_run_raises_producer_errors(self):
+        depositor = DepositorStub()
+        export = ExportDOI('scl', ['0001-0001', 'bad'],
+                           articlemeta=ArticleMetaStub(failing_issn='bad'),
+                           depositor=depositor)
+
+        with self.assertRaises(RuntimeError):
+            export.run()
+
+        self.assertEqual(len(depositor.codes), 300)
+
+    def test_run_stops_pending_producers_when_consumer_fails(self):
+        # somente o primeiro ISSN produz documentos; os demais aguardam até
+        # que o consumidor falhe.
+        gate = threading.Event()
+        issns = ['%04d-0000' % i for i in range(80)]
+        articlemeta = ArticleMetaStub(gate=gate, open_issn=issns[0])
+        export = ExportDOI('scl', issns, articlemeta=articlemeta,
+                           depositor=DepositorStub(fail=True,
+                                                   on_failure=gate.set))
+
+        with self.assertRaises(ValueError):
+            export.run()
+
+        self.assertLessEqual(len(articlemeta.calls), MAX_PRODUCERS)
@@ -0,0 +1,63 @@
+import gzip
+import unittest
+
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, LargeBinary
+
+from doi_request.models.depositor import CompressedText
+
+
+class CompressedTextTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite:///:memory:')
+        metadata = MetaData()
+        self.table = Table(
+            'documents', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('xml', CompressedText))
+        self.raw_table = Table(
+            'documents', MetaData(),
+            Column('id', Integer, primary_key=True),
+            Column('xml', LargeBinary))
+        metadata.create_all(self.engine)
+
+    def _store(self, value):
+        self.engine.execute(self.table.insert().values(id=1, xml=value))
+
+    def _load(self):
+        return self.engine.execute(self.table.select()).fetchone()['xml']
+
+    def _load_raw(self):
+        return self.engine.execute(self.raw_table.select()).fetchone()['xml']
+
+    def test_round_trip_with_non_ascii_text(self):
+        xml = '<doi_batch><titulo>Ação e reflexão — 日本</titulo></doi_batch>'
+        self._store(xml)
+
+        self.assertTrue(bytes(self._load_raw()).startswith(b'\x1f\x8b'))
+        self.assertEqual(self._load(), xml)
+
+    def test_empty_string(self):
+        self._store('')
+
+        self.assertEqual(bytes(self._load_raw()), b'')
+        self.assertEqual(self._load(), '')
+
+    def test_none(self):
+        self._store(None)
+
+        self.assertIsNone(self._load_raw())
+        self.assertIsNone(self._load())
+
+    def test_legacy_uncompressed_value_is_decoded(self):
+        xml = '<doi_batch><titulo>Ação</titulo></doi_batch>'
+        self.engine.execute(
+            self.raw_table.insert().values(id=1, xml=xml.encode('utf-8')))
+
+        self.assertEqual(self._load(), xml)
+
+    def test_stored_value_is_gzip(self):
+        self._store('<doi_batch/>')
+
+        self.assertEqual(
+            gzip.decompress(bytes(self._load_raw())), b'<doi_batch/>')
@@ -0,0 +1,160 @@
+import unittest
+from unittest import mock
+
+from lxml import etree
+
+from tasks import celery
+
+
+SCHEMA = b"""<?xml version="1.0" encoding="UTF-8"?>
+<xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema"
+    targetNamespace="http://www.crossref.org/schema/4.4.0"
+    xmlns="http://www.crossref.org/schema/4.4.0"
+    elementFormDefault="qualified">
+  <xsd:element name="doi_batch">
+    <xsd:complexType>
+      <xsd:sequence>
+        <xsd:element name="head">
+          <xsd:complexType>
+            <xsd:sequence>
+              <xsd:element name="doi_batch_id" type="xsd:string"/>
+              <xsd:element name="depositor">
+                <xsd:complexType>
+                  <xsd:sequence>
+                    <xsd:element name="depositor_name" type="xsd:string"/>
+                    <xsd:element name="email_address" type="xsd:string"/>
+                  </xsd:sequence>
+                </xsd:complexType>
+              </xsd:element>
+              <xsd:element name="registrant" type="xsd:string"/>
+            </xsd:sequence>
+          </xsd:complexType>
+        </xsd:element>
+        <xsd:element name="body">
+          <xsd:complexType>
+            <xsd:sequence>
+              <xsd:element name="doi_data">
+                <xsd:complexType>
+                  <xsd:sequence>
+                    <xsd:element name="doi" type="xsd:string"/>
+                  </xsd:sequence>
+                </xsd:complexType>
+              </xsd:element>
+              <xsd:element name="citation_list" minOccurs="0">
+                <xsd:complexType>
+                  <xsd:sequence>
+                    <xsd:element name="citation" type="xsd:string"
+                        maxOccurs="unbounded"/>
+                  </xsd:sequence>
+                </xsd:complexType>
+              </xsd:element>
+            </xsd:sequence>
+          </xsd:complexType>
+        </xsd:element>
+      </xsd:sequence>
+    </xsd:complexType>
+  </xsd:element>
+</xsd:schema>
+"""
+
+DOCUMENT = """<?xml version='1.0' encoding='utf-8'?>
+<doi_batch xmlns="http://www.crossref.org/schema/4.4.0">
+  <head>
+    <doi_batch_id>S0102-86502002000900005</doi_batch_id>
+    <depositor>
+      <depositor_name>articlemeta</depositor_name>
+      <email_address>articlemeta@scielo.org</email_address>
+    </depositor>
+    <registrant>articlemeta</registrant>
+  </head>
+  <body>
+    <doi_data>
+      <doi>10.1590/wrong</doi>
+    </doi_data>
+    <citation_list>
+      %s
+    </citation_list>
+  </body>
+</doi_batch>"""
+
+VALID_DOCUMENT = DOCUMENT % '<citation>Ação</citation>'
+
+INVALID_DOCUMENT = DOCUMENT % '<bogus/>'
+
+
+class XMLIsValidTest(unittest.TestCase):
+
+    def setUp(self):
+        schema = etree.XMLSchema(etree.fromstring(SCHEMA))
+        patcher = mock.patch.object(celery, '_load_schema', return_value=schema)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _xml_is_valid(self, xml, only_front=False):
+        return celery.xml_is_valid(
+            xml, '10.1590/S0102-86502002000900005', 'SciELO',
+            'scielo@scielo.org', only_front=only_front)
+
+    def test_valid_document(self):
+        is_valid, xml_bytes, doi_batch_id, exc = self._xml_is_valid(
+            VALID_DOCUMENT)
+
+        self.assertTrue(is_valid)
+        self.assertEqual(doi_batch_id, 'S0102-86502002000900005')
+        self.assertEqual(exc, '')
+        self.assertIn('<citation>Ação</citation>', xml_bytes.decode('utf-8'))
+        self.assertIn(
+            '<doi>10.1590/S0102-86502002000900005</doi>',
+            xml_bytes.decode('utf-8'))
+        self.assertIn(
+            '<depositor_name>SciELO</depositor_name>', xml_bytes.decode('utf-8'))
+        self.assertIn(
+            '<email_address>scielo@scielo.org</email_address>',
+            xml_bytes.decode('utf-8'))
+        self.assertIn(
+            '<registrant>SciELO</registrant>', xml_bytes.decode('utf-8'))
+
+    def test_invalid_document_reports_the_line_of_the_error(self):
+        is_valid, xml_bytes, doi_batch_id, exc = self._xml_is_valid(
+            INVALID_DOCUMENT)
+
+        self.assertFalse(is_valid)
+        self.assertEqual(doi_batch_id, '')
+        self.assertIn('bogus', exc)
+        self.assertTrue(exc.endswith('line 16'), exc)
+        self.assertEqual(
+            xml_bytes.decode('utf-8').splitlines()[15].strip(), '<bogus/>')
+
+    def test_invalid_document_is_valid_without_citations(self):
+        is_valid, xml_bytes, doi_batch_id, exc = self._xml_is_valid(
+            INVALID_DOCUMENT, only_front=True)
+
+        self.assertTrue(is_valid)
+        self.assertNotIn('citation_list', xml_bytes.decode('utf-8'))
+
+    def test_malformed_document(self):
+        is_valid, xml_bytes, doi_batch_id, exc = self._xml_is_valid(
+            '<doi_batch><head></doi_batch>')
+
+        self.assertFalse(is_valid)
+        self.assertEqual(xml_bytes, b'<doi_batch><head></doi_batch>')
+        self.assertEqual(doi_batch_id, '')
+        self.assertNotEqual(exc, '')
+
+
+class LoadSchemaTest(unittest.TestCase):
+
+    def setUp(self):
+        celery._load_schema.cache_clear()
+        self.addCleanup(celery._load_schema.cache_clear)
+
+    def test_failures_are_raised_and_not_cached(self):
+        schema = etree.XMLSchema(etree.fromstring(SCHEMA))
+
+        with mock.patch.object(celery.etree, 'XMLSchema',
+                side_effect=[etree.XMLSchemaParseError('network'), schema]):
+            with self.assertRaises(etree.XMLSchemaParseError):
+                celery._load_schema()
+
+            self.assertIs(celery._load_schema(), schema)
+            self.assertIs(celery._load_schema(), schema)